@@ -1,278 +1,381 @@
 
+import os
 import streamlit as st
 import sqlite3
+import queue
 import pandas as pd
-import matplotlib.pyplot as plt
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 st.set_page_config(page_title="Local Food Wastage Management", layout="wide")
 
 DB_PATH = "food_wastage.db"
+# Set FOOD_WASTE_DEV=1 to trace SQL and show each query's EXPLAIN QUERY PLAN
+DEV_MODE = os.environ.get("FOOD_WASTE_DEV") == "1"
 
 # --- DB helpers ---
+# Connection-scoped settings, applied whenever the pool opens a new connection:
+# 64 MiB page cache and mmap so repeated GROUP BYs are served from RAM.
+CONN_PRAGMAS = ("synchronous=NORMAL", "cache_size=-65536", "temp_store=MEMORY", "mmap_size=268435456")
+
+def _connect():
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    for pragma in CONN_PRAGMAS:
+        conn.execute(f"PRAGMA {pragma}")
+    if DEV_MODE:
+        conn.set_trace_callback(print)  # logs each statement, bound values expanded
+    return conn
+
+# Small pool of read-only connections shared across reruns and sessions, so
+# concurrent queries don't serialize on a single sqlite3.Connection.
+POOL_SIZE = 8
+
 @st.cache_resource
+def conn_pool():
+    return queue.Queue(maxsize=POOL_SIZE)  # populated lazily by put_conn
+
 def get_conn():
-    return sqlite3.connect(DB_PATH, check_same_thread=False)
+    try:
+        return conn_pool().get_nowait()
+    except queue.Empty:
+        conn = _connect()
+        conn.execute("PRAGMA query_only=1")
+        return conn
+
+def put_conn(conn):
+    try:
+        conn_pool().put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+# Indexes on the GROUP BY / JOIN columns used by the dashboard queries below.
+INDEX_DDL = (
+    "CREATE INDEX IF NOT EXISTS ix_prov_city ON providers(City)",
+    "CREATE INDEX IF NOT EXISTS ix_prov_type ON providers(Type)",
+    "CREATE INDEX IF NOT EXISTS ix_fl_loc_meal ON food_listings(Location, Meal_Type, Food_Type)",
+    "CREATE INDEX IF NOT EXISTS ix_fl_food_id ON food_listings(Food_ID)",
+    "CREATE INDEX IF NOT EXISTS ix_fl_loc_food ON food_listings(Location, Food_ID)",
+    "CREATE INDEX IF NOT EXISTS ix_fl_meal_food ON food_listings(Meal_Type, Food_ID)",
+    "CREATE INDEX IF NOT EXISTS ix_claims_food_id_status ON claims(Food_ID, Status)",
+    "CREATE INDEX IF NOT EXISTS ix_claims_status ON claims(Status)",
+    "CREATE INDEX IF NOT EXISTS ix_claims_receiver ON claims(Receiver_ID)",
+    # Covering lookups for joining names back onto per-ID aggregates
+    "CREATE INDEX IF NOT EXISTS ix_recv_id_name ON receivers(Receiver_ID, Name)",
+    "CREATE INDEX IF NOT EXISTS ix_prov_id_name ON providers(Provider_ID, Name)",
+    "CREATE INDEX IF NOT EXISTS ix_fl_food_id_name ON food_listings(Food_ID, Food_Name)",
+    "CREATE INDEX IF NOT EXISTS ix_fl_provider_qty ON food_listings(Provider_ID, Quantity)",
+)
+
+# One-time database setup per process. WAL is persistent in the file, so unlike
+# CONN_PRAGMAS it only needs setting once. These are the app's only writes, so they
+# get their own connection; get_conn's are read-only.
+@st.cache_resource
+def _init_db():
+    conn = _connect()
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        for ddl in INDEX_DDL:
+            conn.execute(ddl)
+        conn.execute("ANALYZE")
+        conn.commit()
+    except sqlite3.Error as e:
+        st.warning(f"Database setup failed: {e}")
+    finally:
+        conn.close()
+
+_init_db()
 
-def run_query(sql: str, params: tuple = ()):
+# Results are cached per (sql, params) so reruns with unchanged filters skip SQLite.
+# Cached DataFrames are shared across reruns: don't mutate them in place, use .copy().
+@st.cache_data(ttl=600, show_spinner=False)
+def run_query(sql: str, params: tuple = ()) -> pd.DataFrame:
     conn = get_conn()
     try:
-        df = pd.read_sql_query(sql, conn, params=params)
-        return df
+        # Result sets here are small aggregates with no dates to parse, so build the
+        # DataFrame straight from the cursor instead of going through read_sql_query.
+        cur = conn.execute(sql, params)
+        try:
+            cols = [d[0] for d in cur.description]
+            return pd.DataFrame(cur.fetchall(), columns=cols)
+        finally:
+            cur.close()
     except Exception as e:
         st.warning(f"Query failed: {e}")
         return pd.DataFrame()
+    finally:
+        put_conn(conn)
 
 # --- Sidebar filters (loaded defensively) ---
 st.sidebar.title("Filters")
 
-def get_distinct_values(table, column):
-    try:
-        df = run_query(f"SELECT DISTINCT {column} AS v FROM {table} WHERE {column} IS NOT NULL ORDER BY 1;")
-        return ["All"] + df["v"].dropna().astype(str).tolist()
-    except Exception:
-        return ["All"]
-
-city_options = sorted(list(set(
-    [*get_distinct_values("providers", "City"), *get_distinct_values("food_listings", "Location")]
-)))
-provider_type_options = get_distinct_values("providers", "Type")
-food_type_options = get_distinct_values("food_listings", "Food_Type")
-meal_type_options = get_distinct_values("food_listings", "Meal_Type")
-status_options = get_distinct_values("claims", "Status")
-
-city_filter = st.sidebar.selectbox("City / Location", city_options)
-provider_type_filter = st.sidebar.selectbox("Provider Type", provider_type_options)
-food_type_filter = st.sidebar.selectbox("Food Type", food_type_options)
-meal_type_filter = st.sidebar.selectbox("Meal Type", meal_type_options)
-status_filter = st.sidebar.selectbox("Claim Status", status_options)
-
-# Helper to build WHERE clauses
-def add_where(clauses):
-    clauses = [c for c in clauses if c]
-    return (" WHERE " + " AND ".join(clauses)) if clauses else ""
+# All filter option lists come back from one query as (k, v) rows tagged by source.
+DISTINCT_VALUES_SQL = """
+SELECT 'city' AS k, v FROM (
+    SELECT City AS v FROM providers WHERE City IS NOT NULL
+    UNION
+    SELECT Location FROM food_listings WHERE Location IS NOT NULL
+)
+UNION ALL
+SELECT DISTINCT 'provider_type', Type FROM providers WHERE Type IS NOT NULL
+UNION ALL
+SELECT DISTINCT 'food_type', Food_Type FROM food_listings WHERE Food_Type IS NOT NULL
+UNION ALL
+SELECT DISTINCT 'meal_type', Meal_Type FROM food_listings WHERE Meal_Type IS NOT NULL
+UNION ALL
+SELECT DISTINCT 'status', Status FROM claims WHERE Status IS NOT NULL
+ORDER BY 1, 2;
+"""
+
+@st.cache_data(ttl=600, show_spinner=False)
+def sidebar_options():
+    df = run_query(DISTINCT_VALUES_SQL)
+    # Rows are already distinct and sorted, and TEXT columns come back as str, so
+    # just split them into lists without unique()/astype(str) copies.
+    grouped = df.groupby("k", sort=False)["v"].agg(list) if not df.empty else {}
+    def options(key):
+        return ["All"] + grouped.get(key, [])
+    return {k: options(k) for k in ("city", "provider_type", "food_type", "meal_type", "status")}
+
+opts = sidebar_options()
+city_filter = st.sidebar.selectbox("City / Location", opts["city"])
+provider_type_filter = st.sidebar.selectbox("Provider Type", opts["provider_type"])
+food_type_filter = st.sidebar.selectbox("Food Type", opts["food_type"])
+meal_type_filter = st.sidebar.selectbox("Meal Type", opts["meal_type"])
+status_filter = st.sidebar.selectbox("Claim Status", opts["status"])
+
+# Helper to build a WHERE clause from (condition, value) pairs, skipping "All".
+# Values are always bound, so the SQL text only depends on which filters are set.
+def build_where(conditions):
+    active = [(cond, value) for cond, value in conditions if value != "All"]
+    where = (" WHERE " + " AND ".join(cond for cond, _ in active)) if active else ""
+    return where, tuple(value for _, value in active)
+
+# Current sidebar selection; each method returns a (where, params) pair for one table.
+@dataclass(frozen=True)
+class Filters:
+    city: str
+    ptype: str
+    ftype: str
+    mtype: str
+    status: str
+
+    def providers_where(self, by_type=True):
+        conditions = [("City = ?", self.city)]
+        if by_type:
+            conditions.append(("Type = ?", self.ptype))
+        return build_where(conditions)
+
+    def food_listings_where(self, alias="", by_location=True, by_meal_type=True):
+        prefix = f"{alias}." if alias else ""
+        conditions = []
+        if by_location:
+            conditions.append((f"{prefix}Location = ?", self.city))
+        if by_meal_type:
+            conditions.append((f"{prefix}Meal_Type = ?", self.mtype))
+        return build_where(conditions)
+
+    def claims_where(self):
+        return build_where([("Status = ?", self.status)])
+
+filters = Filters(city_filter, provider_type_filter, food_type_filter, meal_type_filter, status_filter)
 
 # --- KPI summary ---
 st.title("🍽️ Local Food Wastage Management Dashboard")
 
-kpi1 = run_query("SELECT COUNT(*) AS c FROM providers")
-kpi2 = run_query("SELECT COUNT(*) AS c FROM receivers")
-kpi3 = run_query("SELECT COUNT(*) AS c FROM food_listings")
-kpi4 = run_query("SELECT COUNT(*) AS c FROM claims")
+@st.cache_data(ttl=600, show_spinner=False)
+def kpi_counts():
+    df = run_query("""
+SELECT (SELECT COUNT(*) FROM providers) AS p,
+       (SELECT COUNT(*) FROM receivers) AS r,
+       (SELECT COUNT(*) FROM food_listings) AS f,
+       (SELECT COUNT(*) FROM claims) AS c;
+""")
+    if df.empty:
+        return 0, 0, 0, 0
+    row = next(df.itertuples(index=False))
+    return int(row.p), int(row.r), int(row.f), int(row.c)
+
+n_providers, n_receivers, n_listings, n_claims = kpi_counts()
 
 col1, col2, col3, col4 = st.columns(4)
-col1.metric("Providers", int(kpi1["c"].iloc[0]) if not kpi1.empty else 0)
-col2.metric("Receivers", int(kpi2["c"].iloc[0]) if not kpi2.empty else 0)
-col3.metric("Food Listings", int(kpi3["c"].iloc[0]) if not kpi3.empty else 0)
-col4.metric("Claims", int(kpi4["c"].iloc[0]) if not kpi4.empty else 0)
+col1.metric("Providers", n_providers)
+col2.metric("Receivers", n_receivers)
+col3.metric("Food Listings", n_listings)
+col4.metric("Claims", n_claims)
 
 st.markdown("---")
 
 # --- Query 1: Providers per city (Top 10) ---
-st.subheader("Top Cities by Number of Providers")
-where = add_where([
-    None if city_filter == "All" else "City = ?",
-    None if provider_type_filter == "All" else "Type = ?"
-])
-params = tuple([p for p, cond in [
-    (city_filter, city_filter != "All"),
-    (provider_type_filter, provider_type_filter != "All")
-] if cond])
+where1, params1 = filters.providers_where()
 
 query1 = f"""
 SELECT City, COUNT(*) AS provider_count
 FROM providers
-{where}
+{where1}
 GROUP BY City
 ORDER BY provider_count DESC
 LIMIT 10;
 """
-df1 = run_query(query1, params)
-st.dataframe(df1, use_container_width=True)
-if not df1.empty:
-    fig, ax = plt.subplots()
-    ax.bar(df1["City"].astype(str), df1["provider_count"])
-    ax.set_xlabel("City")
-    ax.set_ylabel("Providers")
-    ax.set_title("Top Cities by Providers")
-    plt.xticks(rotation=45, ha="right")
-    st.pyplot(fig)
 
 # --- Query 2: Provider type contributions ---
-st.subheader("Provider Type Contributions")
-where = add_where([
-    None if city_filter == "All" else "City = ?"
-])
-params = tuple([p for p, cond in [
-    (city_filter, city_filter != "All")
-] if cond])
+where2, params2 = filters.providers_where(by_type=False)
 
 query2 = f"""
 SELECT Type, COUNT(*) AS count
 FROM providers
-{where}
+{where2}
 GROUP BY Type
 ORDER BY count DESC;
 """
-df2 = run_query(query2, params)
-st.dataframe(df2, use_container_width=True)
-if not df2.empty:
-    fig, ax = plt.subplots()
-    ax.bar(df2["Type"].astype(str), df2["count"])
-    ax.set_xlabel("Provider Type")
-    ax.set_ylabel("Count")
-    ax.set_title("Provider Type Contributions")
-    plt.xticks(rotation=45, ha="right")
-    st.pyplot(fig)
 
 # --- Query 7: Most common food types ---
-st.subheader("Most Common Food Types")
-where = add_where([
-    None if city_filter == "All" else "Location = ?",
-    None if meal_type_filter == "All" else "Meal_Type = ?"
-])
-params = tuple([p for p, cond in [
-    (city_filter, city_filter != "All"),
-    (meal_type_filter, meal_type_filter != "All")
-] if cond])
+where7, params7 = filters.food_listings_where()
 
 query7 = f"""
 SELECT Food_Type, COUNT(*) AS type_count
 FROM food_listings
-{where}
+{where7}
 GROUP BY Food_Type
 ORDER BY type_count DESC;
 """
-df7 = run_query(query7, params)
-st.dataframe(df7, use_container_width=True)
-if not df7.empty:
-    fig, ax = plt.subplots()
-    ax.bar(df7["Food_Type"].astype(str), df7["type_count"])
-    ax.set_xlabel("Food Type")
-    ax.set_ylabel("Count")
-    ax.set_title("Most Common Food Types")
-    plt.xticks(rotation=45, ha="right")
-    st.pyplot(fig)
 
 # --- Query 10: % Claims by status ---
-st.subheader("Percentage of Claims by Status")
-where = add_where([
-    None if status_filter == "All" else "Status = ?"
-])
-params = tuple([p for p, cond in [
-    (status_filter, status_filter != "All")
-] if cond])
-
-query10_total = f"SELECT COUNT(*) AS total FROM claims{where};"
-total_df = run_query(query10_total, params)
-total = int(total_df["total"].iloc[0]) if not total_df.empty else 0
+where10, params10 = filters.claims_where()
 
+# Single pass over claims; the window SUM supplies the total. A CTE with a scalar
+# COUNT subquery plans worse here (materializes, scans twice, temp B-tree).
 query10 = f"""
 SELECT Status,
-       COUNT(*) * 100.0 / {max(total,1)} AS percentage
+       COUNT(*) * 100.0 / SUM(COUNT(*)) OVER () AS percentage
 FROM claims
-{where}
+{where10}
 GROUP BY Status;
 """
-df10 = run_query(query10, params)
-st.dataframe(df10, use_container_width=True)
-if not df10.empty:
-    fig, ax = plt.subplots()
-    ax.bar(df10["Status"].astype(str), df10["percentage"])
-    ax.set_xlabel("Status")
-    ax.set_ylabel("Percentage")
-    ax.set_title("Claims by Status (%)")
-    plt.xticks(rotation=0)
-    st.pyplot(fig)
 
 # --- Query 12: Most claimed meal type ---
-st.subheader("Most Claimed Meal Type")
-where = add_where([
-    None if meal_type_filter == "All" else "f.Meal_Type = ?"
-])
-params = tuple([p for p, cond in [
-    (meal_type_filter, meal_type_filter != "All")
-] if cond])
+where12, params12 = filters.food_listings_where("f", by_location=False)
 
 query12 = f"""
 SELECT f.Meal_Type, COUNT(c.Claim_ID) AS claims_count
 FROM food_listings f
 JOIN claims c ON f.Food_ID = c.Food_ID
-{where}
+{where12}
 GROUP BY f.Meal_Type
 ORDER BY claims_count DESC;
 """
-df12 = run_query(query12, params)
-st.dataframe(df12, use_container_width=True)
-if not df12.empty:
-    fig, ax = plt.subplots()
-    ax.bar(df12["Meal_Type"].astype(str), df12["claims_count"])
-    ax.set_xlabel("Meal Type")
-    ax.set_ylabel("Claims")
-    ax.set_title("Most Claimed Meal Type")
-    plt.xticks(rotation=0)
-    st.pyplot(fig)
 
 # --- Query 14: Top locations by completed claims ---
-st.subheader("Top 5 Locations by Completed Claims")
-where = add_where([
-    None if city_filter == "All" else "f.Location = ?"
-])
-params = tuple([p for p, cond in [
-    (city_filter, city_filter != "All")
-] if cond])
+where14, params14 = filters.food_listings_where("f", by_meal_type=False)
+params14 = ("Completed",) + params14  # claims subquery's Status = ? comes first
 
 query14 = f"""
-SELECT f.Location, COUNT(c.Claim_ID) AS completed_claims
+SELECT f.Location, COUNT(*) AS completed_claims
 FROM food_listings f
-JOIN claims c ON f.Food_ID = c.Food_ID
-WHERE c.Status = 'Completed'{" AND " + where[7:] if where else ""}
+JOIN (SELECT Food_ID FROM claims WHERE Status = ?) c USING (Food_ID)
+{where14}
 GROUP BY f.Location
 ORDER BY completed_claims DESC
 LIMIT 5;
 """
-df14 = run_query(query14, params)
-st.dataframe(df14, use_container_width=True)
-if not df14.empty:
-    fig, ax = plt.subplots()
-    ax.bar(df14["Location"].astype(str), df14["completed_claims"])
-    ax.set_xlabel("Location")
-    ax.set_ylabel("Completed Claims")
-    ax.set_title("Top 5 Locations by Completed Claims")
-    plt.xticks(rotation=0)
-    st.pyplot(fig)
 
 # --- Extra analyses (tables only) ---
-st.subheader("Receivers with Most Claims")
+# Aggregate on the integer FK first, then join names back. Names aren't unique,
+# so the outer GROUP BY still merges rows that share a name.
 query4 = """
-SELECT r.Name, COUNT(c.Claim_ID) AS claims_count
-FROM receivers r
-JOIN claims c ON r.Receiver_ID = c.Receiver_ID
+SELECT r.Name, SUM(c.claims_count) AS claims_count
+FROM (SELECT Receiver_ID, COUNT(*) AS claims_count FROM claims GROUP BY Receiver_ID) c
+JOIN receivers r USING (Receiver_ID)
 GROUP BY r.Name
 ORDER BY claims_count DESC
 LIMIT 10;
 """
-st.dataframe(run_query(query4), use_container_width=True)
 
-st.subheader("Claims per Food Item")
 query8 = """
-SELECT f.Food_Name, COUNT(c.Claim_ID) AS claims_count
-FROM food_listings f
-JOIN claims c ON f.Food_ID = c.Food_ID
+SELECT f.Food_Name, SUM(c.claims_count) AS claims_count
+FROM (SELECT Food_ID, COUNT(*) AS claims_count FROM claims GROUP BY Food_ID) c
+JOIN food_listings f USING (Food_ID)
 GROUP BY f.Food_Name
 ORDER BY claims_count DESC
 LIMIT 15;
 """
-st.dataframe(run_query(query8), use_container_width=True)
 
-st.subheader("Total Quantity Donated by Provider")
 query13 = """
-SELECT p.Name, SUM(f.Quantity) AS total_donated
-FROM providers p
-JOIN food_listings f ON p.Provider_ID = f.Provider_ID
+SELECT p.Name, SUM(f.total_donated) AS total_donated
+FROM (SELECT Provider_ID, SUM(Quantity) AS total_donated FROM food_listings GROUP BY Provider_ID) f
+JOIN providers p USING (Provider_ID)
 GROUP BY p.Name
 ORDER BY total_donated DESC
 LIMIT 15;
 """
-st.dataframe(run_query(query13), use_container_width=True)
+
+# --- Run all queries concurrently, then render in page order ---
+tasks = {
+    "df1": (query1, params1),
+    "df2": (query2, params2),
+    "df7": (query7, params7),
+    "df10": (query10, params10),
+    "df12": (query12, params12),
+    "df14": (query14, params14),
+    "df4": (query4, ()),
+    "df8": (query8, ()),
+    "df13": (query13, ()),
+}
+# Workers share this run's script context so run_query's cache and warnings work there.
+ctx = get_script_run_ctx()
+with ThreadPoolExecutor(max_workers=4, initializer=add_script_run_ctx, initargs=(None, ctx)) as ex:
+    futures = {k: ex.submit(run_query, sql, p) for k, (sql, p) in tasks.items()}
+
+st.subheader("Top Cities by Number of Providers")
+df1 = futures["df1"].result()
+st.dataframe(df1, use_container_width=True)
+if not df1.empty:
+    st.bar_chart(df1, x="City", y="provider_count", x_label="City", y_label="Providers", sort=False)
+
+st.subheader("Provider Type Contributions")
+df2 = futures["df2"].result()
+st.dataframe(df2, use_container_width=True)
+if not df2.empty:
+    st.bar_chart(df2, x="Type", y="count", x_label="Provider Type", y_label="Count", sort=False)
+
+st.subheader("Most Common Food Types")
+df7 = futures["df7"].result()
+st.dataframe(df7, use_container_width=True)
+if not df7.empty:
+    st.bar_chart(df7, x="Food_Type", y="type_count", x_label="Food Type", y_label="Count", sort=False)
+
+st.subheader("Percentage of Claims by Status")
+df10 = futures["df10"].result()
+st.dataframe(df10, use_container_width=True)
+if not df10.empty:
+    st.bar_chart(df10, x="Status", y="percentage", x_label="Status", y_label="Percentage", sort=False)
+
+st.subheader("Most Claimed Meal Type")
+df12 = futures["df12"].result()
+st.dataframe(df12, use_container_width=True)
+if not df12.empty:
+    st.bar_chart(df12, x="Meal_Type", y="claims_count", x_label="Meal Type", y_label="Claims", sort=False)
+
+st.subheader("Top 5 Locations by Completed Claims")
+df14 = futures["df14"].result()
+st.dataframe(df14, use_container_width=True)
+if not df14.empty:
+    st.bar_chart(df14, x="Location", y="completed_claims", x_label="Location", y_label="Completed Claims", sort=False)
+
+st.subheader("Receivers with Most Claims")
+st.dataframe(futures["df4"].result(), use_container_width=True)
+
+st.subheader("Claims per Food Item")
+st.dataframe(futures["df8"].result(), use_container_width=True)
+
+st.subheader("Total Quantity Donated by Provider")
+st.dataframe(futures["df13"].result(), use_container_width=True)
+
+if DEV_MODE:
+    with st.expander("Query plans"):
+        for k, (sql, p) in tasks.items():
+            plan = run_query("EXPLAIN QUERY PLAN " + sql, p)
+            st.text(k)
+            st.code("\n".join(plan["detail"]) if not plan.empty else "", language=None)
 
 st.caption("Tip: Use the filters in the sidebar to refine the dashboard.")